@@ -40,6 +40,7 @@ CREATE TABLE vulnerabilities (
 -- Indexes for performance
 CREATE INDEX idx_scan_jobs_status ON scan_jobs(status);
 CREATE INDEX idx_scan_jobs_created_at ON scan_jobs(created_at);
+CREATE INDEX idx_scan_jobs_active_target ON scan_jobs(target) WHERE status IN ('queued', 'scanning');
 CREATE INDEX idx_vulnerabilities_scan_job ON vulnerabilities(scan_job_id);
 CREATE INDEX idx_vulnerabilities_severity ON vulnerabilities(severity);
 
@@ -1,12 +1,19 @@
-import json
 import os
-import uuid
 import boto3
+import orjson
+from botocore.config import Config
 import psycopg2
 from datetime import datetime
 
 # Initialize AWS clients
-sqs = boto3.client('sqs')
+# Module-scope client keeps its pooled HTTPS connection alive across warm invocations
+sqs = boto3.client('sqs', config=Config(
+    retries={'mode': 'standard'},
+    tcp_keepalive=True,
+    max_pool_connections=10
+))
+if sqs.meta.service_model.protocol != 'json':
+    print(f"Warning: SQS client is using the {sqs.meta.service_model.protocol} protocol; upgrade boto3 to >=1.34 for JSON")
 
 # Environment variables
 QUEUE_URL = os.environ.get('SQS_QUEUE_URL', '')
@@ -14,49 +21,131 @@ DB_HOST = os.environ.get('DB_HOST', '')
 DB_NAME = os.environ.get('DB_NAME', '')
 DB_USER = os.environ.get('DB_USER', '')
 DB_PASSWORD = os.environ.get('DB_PASSWORD', '')
+DEBUG = os.environ.get('DEBUG') == '1'
+
+# Static response headers, built once per execution environment
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+_CORS_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
+
+# Database connection reused across warm invocations of this execution environment
+_CONN = None
 
 def get_db_connection():
-    """Create database connection"""
+    """Return the cached database connection, opening it if needed"""
+    global _CONN
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            connect_timeout=5,
-            sslmode='require'
-        )
-        return conn
+        if _CONN is None or _CONN.closed:
+            _CONN = psycopg2.connect(
+                host=DB_HOST,
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                connect_timeout=5,
+                sslmode='require',
+                application_name='vuln-scanner-submit'
+            )
+        return _CONN
     except Exception as e:
         print(f"Database connection error: {str(e)}")
         raise
 
-def create_scan_record(scan_id, scan_type, target):
-    """Create scan record in database"""
-    conn = None
+def run_with_db(func, *args):
+    """Run func(conn, *args), reconnecting and retrying once on a dropped connection"""
+    global _CONN
+    try:
+        return func(get_db_connection(), *args)
+    except psycopg2.OperationalError as e:
+        print(f"Database connection lost, reconnecting: {str(e)}")
+        if _CONN is not None:
+            _CONN.close()
+            _CONN = None
+        return func(get_db_connection(), *args)
+
+def ping_db(conn):
+    """Round-trip a trivial query to keep the connection alive"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT 1")
+        conn.rollback()
+    finally:
+        cursor.close()
+
+# Connect during cold-start init so the first invocation doesn't pay the handshake
+if DB_HOST:
+    try:
+        get_db_connection()
+    except Exception:
+        _CONN = None
+
+def find_active_scan(cursor, scan_type, target):
+    """Return (scan_id, status) of a recent queued/scanning scan of target, or None"""
+    query = """
+        SELECT id, status FROM scan_jobs
+        WHERE target = %s AND scan_type = %s
+          AND status IN ('queued', 'scanning')
+          AND created_at > NOW() - INTERVAL '5 minutes'
+        ORDER BY created_at DESC
+        LIMIT 1
+    """
+    
+    cursor.execute(query, (target, scan_type))
+    return cursor.fetchone()
+
+def create_scan_record(cursor, scan_type, target):
+    """Create scan record in database, returning its generated ID"""
+    query = """
+        INSERT INTO scan_jobs (scan_type, target, status, created_at)
+        VALUES (%s, %s, %s, NOW())
+        RETURNING id
+    """
+    
+    cursor.execute(query, (scan_type, target, 'queued'))
+    return cursor.fetchone()[0]
+
+def register_scan(conn, scan_type, target):
+    """Return (scan_id, status, created), leaving a newly queued record uncommitted"""
+    cursor = None
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
         
-        query = """
-            INSERT INTO scan_jobs (id, scan_type, target, status, created_at)
-            VALUES (%s, %s, %s, %s, NOW())
-        """
-        
-        cursor.execute(query, (scan_id, scan_type, target, 'queued'))
-        conn.commit()
-        cursor.close()
+        # Serialize submissions of the same target until this transaction ends
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (target,))
+        active = find_active_scan(cursor, scan_type, target)
+        if active:
+            # Nothing written; end the transaction so the cached connection isn't left idle in it
+            conn.rollback()
+            return active[0], active[1], False
         
-        print(f"Created scan record in database: {scan_id}")
+        scan_id = create_scan_record(cursor, scan_type, target)
+        return scan_id, 'queued', True
         
     except Exception as e:
         print(f"Error creating scan record: {str(e)}")
-        if conn:
+        if not conn.closed:
             conn.rollback()
         raise
     finally:
-        if conn:
-            conn.close()
+        if cursor:
+            cursor.close()
+
+def mark_scan_failed(conn, scan_id, error_message):
+    """Mark a scan that never reached the queue as failed"""
+    cursor = None
+    try:
+        conn.rollback()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE scan_jobs SET status = 'failed', completed_at = NOW(), error_message = %s "
+            "WHERE id = %s AND status = 'queued'",
+            (error_message, scan_id)
+        )
+        conn.commit()
+    finally:
+        if cursor:
+            cursor.close()
 
 def lambda_handler(event, context):
     """
@@ -64,24 +153,35 @@ def lambda_handler(event, context):
     """
     
     try:
-        print(f"Received event: {json.dumps(event)}")
+        # Scheduled warm-up ping: keep the DB connection alive and skip all side effects
+        if event.get('warmer') is True:
+            run_with_db(ping_db)
+            return {
+                'statusCode': 200,
+                'headers': _JSON_HEADERS,
+                'body': orjson.dumps({'warm': True}).decode()
+            }
+        
+        if DEBUG:
+            print("Received event:", event)
         
         # Parse request body
         if 'body' in event:
-            body = json.loads(event['body'])
+            body = orjson.loads(event['body'])
         else:
             body = event  # For testing
         
-        print(f"Parsed body: {json.dumps(body)}")
+        if DEBUG:
+            print("Parsed body:", body)
         
         # Validate required fields
         if 'type' not in body or 'target' not in body:
             return {
                 'statusCode': 400,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps({
+                'headers': _JSON_HEADERS,
+                'body': orjson.dumps({
                     'error': 'Missing required fields: type and target'
-                })
+                }).decode()
             }
         
         scan_type = body['type']
@@ -91,10 +191,10 @@ def lambda_handler(event, context):
         if scan_type not in ['docker-image', 'web-url']:
             return {
                 'statusCode': 400,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps({
+                'headers': _JSON_HEADERS,
+                'body': orjson.dumps({
                     'error': 'Invalid scan type. Must be docker-image or web-url'
-                })
+                }).decode()
             }
         
         # Validate target format
@@ -102,33 +202,56 @@ def lambda_handler(event, context):
             if ':' not in target and '@' not in target:
                 target = f"{target}:latest"
         
-        # Generate unique scan ID
-        scan_id = str(uuid.uuid4())
-        print(f"Generated scan_id: {scan_id}")
-        
-        # Create database record
-        create_scan_record(scan_id, scan_type, target)
-        
-        # Send message to SQS
-        message_body = {
-            'scan_id': scan_id,
-            'type': scan_type,
-            'target': target,
-            'created_at': datetime.utcnow().isoformat()
-        }
-        
-        print(f"Sending message to SQS: {json.dumps(message_body)}")
+        # Collapse duplicate submissions onto the scan already in flight;
+        # otherwise the scan ID comes from the id column default
+        scan_id, status, created = run_with_db(register_scan, scan_type, target)
+        if not created:
+            print(f"Scan already in progress for {target}: {scan_id}")
+            return {
+                'statusCode': 202,
+                'headers': _CORS_HEADERS,
+                'body': orjson.dumps({
+                    'scan_id': scan_id,
+                    'status': status,
+                    'message': 'Scan already in progress',
+                    'type': scan_type,
+                    'target': target
+                }).decode()
+            }
         
-        response = sqs.send_message(
-            QueueUrl=QUEUE_URL,
-            MessageBody=json.dumps(message_body),
-            MessageAttributes={
-                'scan_type': {
-                    'StringValue': scan_type,
-                    'DataType': 'String'
-                }
+        try:
+            # Commit outside run_with_db so an ambiguous commit is never retried
+            _CONN.commit()
+            print(f"Created scan record in database: {scan_id}")
+            
+            # Send message to SQS
+            message_body = {
+                'scan_id': scan_id,
+                'type': scan_type,
+                'target': target,
+                'created_at': datetime.utcnow().isoformat()
             }
-        )
+            
+            if DEBUG:
+                print("Sending message to SQS:", message_body)
+            
+            response = sqs.send_message(
+                QueueUrl=QUEUE_URL,
+                MessageBody=orjson.dumps(message_body).decode(),
+                MessageAttributes={
+                    'scan_type': {
+                        'StringValue': scan_type,
+                        'DataType': 'String'
+                    }
+                }
+            )
+        except Exception as e:
+            # Don't leave a queued row behind for duplicate detection to match forever
+            try:
+                run_with_db(mark_scan_failed, scan_id, f"Failed to queue scan: {str(e)}")
+            except Exception as mark_error:
+                print(f"Error marking scan {scan_id} failed: {str(mark_error)}")
+            raise
         
         message_id = response.get('MessageId', 'unknown')
         print(f"Message sent to SQS. MessageId: {message_id}")
@@ -136,17 +259,14 @@ def lambda_handler(event, context):
         # Return success response
         return {
             'statusCode': 202,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
+            'headers': _CORS_HEADERS,
+            'body': orjson.dumps({
                 'scan_id': scan_id,
                 'status': 'queued',
                 'message': 'Scan request queued successfully',
                 'type': scan_type,
                 'target': target
-            })
+            }).decode()
         }
         
     except Exception as e:
@@ -156,9 +276,9 @@ def lambda_handler(event, context):
         print(f"Traceback: {error_trace}")
         return {
             'statusCode': 500,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({
+            'headers': _JSON_HEADERS,
+            'body': orjson.dumps({
                 'error': 'Internal server error',
                 'details': str(e)
-            })
+            }).decode()
         }
@@ -1,12 +1,26 @@
-import json
+import csv
+import fcntl
+import gzip
+import io
 import os
+import shutil
 import boto3
+import ijson
+import orjson
+from botocore.config import Config
 import subprocess
+import tempfile
 import psycopg2
-from datetime import datetime
+from psycopg2.extras import execute_values
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import time
 
-sqs = boto3.client('sqs')
+sqs = boto3.client('sqs', config=Config(retries={'mode': 'standard'}))
+if sqs.meta.service_model.protocol != 'json':
+    print(f"Warning: SQS client is using the {sqs.meta.service_model.protocol} protocol; upgrade boto3 to >=1.34 for JSON")
 s3 = boto3.client('s3')
 
 QUEUE_URL = os.environ.get('SQS_QUEUE_URL')
@@ -15,6 +29,28 @@ DB_HOST = os.environ.get('DB_HOST')
 DB_NAME = os.environ.get('DB_NAME')
 DB_USER = os.environ.get('DB_USER')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '2'))
+
+# Upper bound on a single Trivy run
+SCAN_TIMEOUT = 600
+# Upper bound on downloading one Trivy DB
+DB_DOWNLOAD_TIMEOUT = 300
+# Worst case before a scan starts: waiting out another worker's refresh of
+# both DBs, then refreshing both ourselves if that one failed
+DB_REFRESH_TIMEOUT = 4 * DB_DOWNLOAD_TIMEOUT
+# Received messages must stay hidden for longer than the DB refresh, the
+# slowest scan and its S3 upload and DB writes, or SQS redelivers them mid-scan
+VISIBILITY_TIMEOUT = DB_REFRESH_TIMEOUT + SCAN_TIMEOUT + 300
+TRIVY_CACHE_DIR = os.environ.get('TRIVY_CACHE_DIR', '/mnt/trivy-cache')
+
+# (cache subdir, DB file, download flag) for each Trivy DB shared across scans
+TRIVY_DBS = (
+    ('db', 'trivy.db', '--download-db-only'),
+    ('java-db', 'trivy-java.db', '--download-java-db-only')
+)
+
+# Scans with at least this many vulnerabilities are bulk loaded with COPY
+COPY_THRESHOLD = 1000
 
 def get_db_connection():
     """Connect to PostgreSQL database"""
@@ -24,122 +60,230 @@ def get_db_connection():
         user=DB_USER,
         password=DB_PASSWORD,
         connect_timeout=10,
-        sslmode='require'
+        sslmode='require',
+        application_name='vuln-scanner-worker'
     )
 
-def update_scan_status(scan_id, status, error_message=None):
+# Constant UPDATEs keyed by target status
+_STATUS_UPDATES = {
+    'scanning': "UPDATE scan_jobs SET status = 'scanning', started_at = NOW() WHERE id = %(scan_id)s",
+    'completed': "UPDATE scan_jobs SET status = 'completed', completed_at = NOW() WHERE id = %(scan_id)s",
+    'failed': "UPDATE scan_jobs SET status = 'failed', completed_at = NOW(), error_message = %(error_message)s WHERE id = %(scan_id)s"
+}
+
+def _execute_status_update(cursor, scan_id, status, error_message=None):
+    """Issue the UPDATE for a status transition on an open cursor"""
+    cursor.execute(_STATUS_UPDATES[status], {'scan_id': scan_id, 'error_message': error_message})
+
+def update_scan_status(conn, scan_id, status, error_message=None):
     """Update scan status in database"""
-    conn = None
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
-        
-        if status == 'scanning':
-            query = "UPDATE scan_jobs SET status = %s, started_at = NOW() WHERE id = %s"
-            cursor.execute(query, (status, scan_id))
-        elif status == 'completed':
-            query = "UPDATE scan_jobs SET status = %s, completed_at = NOW() WHERE id = %s"
-            cursor.execute(query, (status, scan_id))
-        elif status == 'failed':
-            query = "UPDATE scan_jobs SET status = %s, completed_at = NOW(), error_message = %s WHERE id = %s"
-            cursor.execute(query, (status, error_message, scan_id))
-        
+        _execute_status_update(cursor, scan_id, status, error_message)
         conn.commit()
         cursor.close()
         print(f"Updated scan {scan_id} status to: {status}")
     except Exception as e:
         print(f"Error updating status: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+        conn.rollback()
 
-def store_vulnerabilities(scan_id, vulnerabilities):
-    """Store vulnerabilities in database"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        query = """
-            INSERT INTO vulnerabilities 
-            (scan_job_id, cve_id, severity, package_name, installed_version, fixed_version, title, description)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        
-        count = 0
+def store_vulnerabilities(cursor, scan_id, vulnerabilities):
+    """Insert vulnerabilities on an open cursor, returning the severity summary"""
+    columns = "(scan_job_id, cve_id, severity, package_name, installed_version, fixed_version, title, description)"
+    counts = Counter()
+    
+    def rows():
         for vuln in vulnerabilities:
-            cursor.execute(query, (
+            counts[vuln.get('Severity')] += 1
+            # CSV COPY loads '' as NULL, so store empty fields as NULL on both paths
+            yield (
                 scan_id,
-                vuln.get('VulnerabilityID'),
-                vuln.get('Severity'),
-                vuln.get('PkgName'),
-                vuln.get('InstalledVersion'),
-                vuln.get('FixedVersion'),
-                vuln.get('Title'),
-                vuln.get('Description')
-            ))
-            count += 1
-        
+                vuln.get('VulnerabilityID') or None,
+                vuln.get('Severity') or None,
+                vuln.get('PkgName') or None,
+                vuln.get('InstalledVersion') or None,
+                vuln.get('FixedVersion') or None,
+                vuln.get('Title') or None,
+                vuln.get('Description') or None
+            )
+    
+    # Peek at the first COPY_THRESHOLD rows to pick multi-VALUES INSERT or COPY
+    pending = rows()
+    head = list(islice(pending, COPY_THRESHOLD))
+    if len(head) < COPY_THRESHOLD:
+        execute_values(cursor, f"INSERT INTO vulnerabilities {columns} VALUES %s", head, page_size=500)
+    else:
+        buf = io.StringIO()
+        csv.writer(buf).writerows(chain(head, pending))
+        buf.seek(0)
+        cursor.copy_expert(f"COPY vulnerabilities {columns} FROM STDIN WITH (FORMAT csv)", buf)
+    
+    return {
+        'total': sum(counts.values()),
+        'critical': counts['CRITICAL'],
+        'high': counts['HIGH'],
+        'medium': counts['MEDIUM'],
+        'low': counts['LOW']
+    }
+
+def complete_scan(conn, scan_id, vulnerabilities):
+    """Store vulnerabilities and mark the scan completed in one transaction"""
+    try:
+        cursor = conn.cursor()
+        summary = store_vulnerabilities(cursor, scan_id, vulnerabilities)
+        _execute_status_update(cursor, scan_id, 'completed')
         conn.commit()
         cursor.close()
-        print(f"Stored {count} vulnerabilities for scan {scan_id}")
+        print(f"Stored {summary['total']} vulnerabilities for scan {scan_id}")
+        print(f"Updated scan {scan_id} status to: completed")
+        return summary
     except Exception as e:
         print(f"Error storing vulnerabilities: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+        conn.rollback()
+        raise
 
-def scan_docker_image(image_name):
-    """Run Trivy scan on Docker image"""
+def iter_vulnerabilities(report_file):
+    """Stream vulnerabilities out of a Trivy JSON report file"""
+    return ijson.items(report_file, 'Results.item.Vulnerabilities.item')
+
+def resolve_trivy_cache_dir():
+    """Return TRIVY_CACHE_DIR if writable, otherwise a directory under /tmp"""
+    try:
+        os.makedirs(TRIVY_CACHE_DIR, exist_ok=True)
+        if os.access(TRIVY_CACHE_DIR, os.W_OK):
+            return TRIVY_CACHE_DIR
+    except OSError:
+        pass
+    fallback = os.path.join(tempfile.gettempdir(), 'trivy-cache')
+    print(f"Trivy cache dir {TRIVY_CACHE_DIR} is not writable; using {fallback}")
+    os.makedirs(fallback, exist_ok=True)
+    return fallback
+
+def trivy_db_is_fresh(db_dir, db_file):
+    """Check a Trivy DB dir the way Trivy does before skipping an update"""
+    try:
+        with open(os.path.join(db_dir, 'metadata.json'), 'rb') as f:
+            metadata = orjson.loads(f.read())
+        next_update = datetime.strptime(metadata['NextUpdate'][:19], '%Y-%m-%dT%H:%M:%S')
+        downloaded_at = datetime.strptime(metadata['DownloadedAt'][:19], '%Y-%m-%dT%H:%M:%S')
+    except (OSError, KeyError, TypeError, ValueError):
+        return False
+    
+    if not os.path.exists(os.path.join(db_dir, db_file)):
+        return False
+    # Like Trivy, don't re-download more than hourly if upstream is late publishing
+    now = datetime.utcnow()
+    return now < next_update or now - downloaded_at < timedelta(hours=1)
+
+def refresh_trivy_db(cache_dir, name, download_flag):
+    """Download a Trivy DB into a new version dir and atomically repoint cache_dir/name at it"""
+    versions_dir = os.path.join(cache_dir, '.versions')
+    os.makedirs(versions_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f'{name}-', dir=versions_dir)
+    
+    print(f"Downloading Trivy {name} into {cache_dir}")
+    result = subprocess.run(
+        ['trivy', 'image', download_flag, '--quiet', '--cache-dir', staging],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        timeout=DB_DOWNLOAD_TIMEOUT
+    )
+    if result.returncode != 0:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise Exception(f"Trivy {name} download failed: {result.stderr.decode('utf-8', 'replace')}")
+    
+    # Scans in progress keep reading the previous version through their own links
+    link = os.path.join(cache_dir, name)
+    previous = os.path.basename(os.path.dirname(os.path.realpath(link))) if os.path.islink(link) else None
+    new_link = f"{link}.new"
+    if os.path.lexists(new_link):
+        os.remove(new_link)
+    os.symlink(os.path.join('.versions', os.path.basename(staging), name), new_link)
+    if os.path.isdir(link) and not os.path.islink(link):
+        shutil.rmtree(link)
+    os.replace(new_link, link)
+    
+    # Keep the current and previous versions only
+    for entry in os.listdir(versions_dir):
+        if entry.startswith(f'{name}-') and entry not in (os.path.basename(staging), previous):
+            shutil.rmtree(os.path.join(versions_dir, entry), ignore_errors=True)
+
+def ensure_trivy_db():
+    """Return the shared cache dir, refreshing stale Trivy DBs under a file lock"""
+    cache_dir = resolve_trivy_cache_dir()
+    if all(trivy_db_is_fresh(os.path.join(cache_dir, name), db_file) for name, db_file, _ in TRIVY_DBS):
+        return cache_dir
+    
+    with open(os.path.join(cache_dir, '.download.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for name, db_file, download_flag in TRIVY_DBS:
+            # Another worker may have refreshed it while we waited
+            if not trivy_db_is_fresh(os.path.join(cache_dir, name), db_file):
+                refresh_trivy_db(cache_dir, name, download_flag)
+    return cache_dir
+
+def trivy_cache_args(work_dir):
+    """Build Trivy cache flags for one scan, using a private cache dir linked to the shared DBs"""
+    shared_cache_dir = ensure_trivy_db()
+    
+    cache_dir = os.path.join(work_dir, 'cache')
+    os.makedirs(cache_dir)
+    for name, _, _ in TRIVY_DBS:
+        # Pin the version current at scan start, in case a refresh swaps it mid-scan
+        os.symlink(os.path.realpath(os.path.join(shared_cache_dir, name)), os.path.join(cache_dir, name))
+    return ['--cache-dir', cache_dir, '--skip-db-update', '--skip-java-db-update']
+
+def scan_docker_image(image_name, work_dir):
+    """Run Trivy scan on Docker image, returning the path of the JSON report"""
     print(f"Scanning Docker image: {image_name}")
     
+    # Trivy writes its report straight to disk rather than through a stdout pipe
+    output_path = os.path.join(work_dir, 'results.json')
     try:
         result = subprocess.run(
-            ['trivy', 'image', '--format', 'json', '--quiet', image_name],
-            capture_output=True,
-            text=True,
-            timeout=600
+            ['trivy', 'image', '--format', 'json', '--quiet', '--output', output_path]
+            + trivy_cache_args(work_dir)
+            + [image_name],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=SCAN_TIMEOUT
         )
         
         if result.returncode != 0:
-            raise Exception(f"Trivy scan failed: {result.stderr}")
-        
-        scan_results = json.loads(result.stdout)
+            raise Exception(f"Trivy scan failed: {result.stderr.decode('utf-8', 'replace')}")
         
-        vulnerabilities = []
-        if 'Results' in scan_results:
-            for result in scan_results['Results']:
-                if 'Vulnerabilities' in result and result['Vulnerabilities']:
-                    vulnerabilities.extend(result['Vulnerabilities'])
-        
-        print(f"Found {len(vulnerabilities)} vulnerabilities")
-        return {
-            'scan_results': scan_results,
-            'vulnerabilities': vulnerabilities,
-            'summary': {
-                'total': len(vulnerabilities),
-                'critical': sum(1 for v in vulnerabilities if v.get('Severity') == 'CRITICAL'),
-                'high': sum(1 for v in vulnerabilities if v.get('Severity') == 'HIGH'),
-                'medium': sum(1 for v in vulnerabilities if v.get('Severity') == 'MEDIUM'),
-                'low': sum(1 for v in vulnerabilities if v.get('Severity') == 'LOW')
-            }
-        }
+        return output_path
     except Exception as e:
         print(f"Scan error: {e}")
         raise
 
-def process_message(message):
-    """Process a single scan message"""
+def upload_report(scan_id, report_path):
+    """Gzip the raw Trivy report and upload it to S3, returning the key"""
+    s3_key = f"scans/{scan_id}/results.json.gz"
+    gz_path = f"{report_path}.gz"
+    with open(report_path, 'rb') as src, gzip.open(gz_path, 'wb', compresslevel=6) as gz:
+        shutil.copyfileobj(src, gz)
+    
+    # upload_fileobj switches to multipart automatically for large reports
+    with open(gz_path, 'rb') as f:
+        s3.upload_fileobj(
+            f,
+            S3_BUCKET,
+            s3_key,
+            ExtraArgs={'ContentType': 'application/json', 'ContentEncoding': 'gzip'}
+        )
+    return s3_key
+
+def process_message(message_body):
+    """Process a single scan message body, returning True if it can be deleted"""
+    conn = None
+    scan_id = None
+    work_dir = tempfile.mkdtemp(prefix='trivy-')
     try:
-        body = json.loads(message['Body'])
+        body = orjson.loads(message_body)
         scan_id = body['scan_id']
         scan_type = body['type']
         target = body['target']
-        receipt_handle = message['ReceiptHandle']
         
         print(f"\n{'='*60}")
         print(f"Processing scan: {scan_id}")
@@ -147,71 +291,107 @@ def process_message(message):
         print(f"Target: {target}")
         print(f"{'='*60}")
         
-        update_scan_status(scan_id, 'scanning')
+        # One connection for every status change and insert of this scan
+        conn = get_db_connection()
+        update_scan_status(conn, scan_id, 'scanning')
         
         if scan_type == 'docker-image':
-            results = scan_docker_image(target)
+            report_path = scan_docker_image(target, work_dir)
         else:
             raise Exception(f"Unsupported scan type: {scan_type}")
         
-        s3_key = f"scans/{scan_id}/results.json"
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=s3_key,
-            Body=json.dumps(results['scan_results'], indent=2),
-            ContentType='application/json'
-        )
+        s3_key = upload_report(scan_id, report_path)
         print(f"Uploaded results to S3: {s3_key}")
         
-        if results['vulnerabilities']:
-            store_vulnerabilities(scan_id, results['vulnerabilities'])
-        
-        update_scan_status(scan_id, 'completed')
+        with open(report_path, 'rb') as f:
+            summary = complete_scan(conn, scan_id, iter_vulnerabilities(f))
         
-        sqs.delete_message(
-            QueueUrl=QUEUE_URL,
-            ReceiptHandle=receipt_handle
-        )
-        print(f"Deleted message from SQS")
         print(f"Scan completed successfully!")
-        print(f"Summary: {results['summary']}")
+        print(f"Summary: {summary}")
+        return True
         
     except Exception as e:
         print(f"Error processing message: {e}")
-        try:
-            update_scan_status(scan_id, 'failed', str(e))
-        except:
-            pass
+        if scan_id:
+            try:
+                if conn is None:
+                    conn = get_db_connection()
+                update_scan_status(conn, scan_id, 'failed', str(e))
+            except:
+                pass
+        return False
+    finally:
+        if conn:
+            conn.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def lambda_handler(event, context):
+    """Scan SQS event source mapping records one at a time, reporting failed ones"""
+    failures = []
+    for record in event.get('Records', []):
+        if not process_message(record['body']):
+            failures.append({'itemIdentifier': record['messageId']})
+    
+    return {'batchItemFailures': failures}
 
 def main():
-    """Main worker loop"""
+    """Main worker loop for long-running (ECS) deployments"""
     print("Scanner worker starting...")
     print(f"Queue URL: {QUEUE_URL}")
     print(f"S3 Bucket: {S3_BUCKET}")
     print(f"Database: {DB_HOST}")
     print("\nPolling for messages...\n")
     
-    while True:
-        try:
-            response = sqs.receive_message(
-                QueueUrl=QUEUE_URL,
-                MaxNumberOfMessages=1,
-                WaitTimeSeconds=20, 
-                VisibilityTimeout=300 
-            )
-            
-            if 'Messages' in response:
-                for message in response['Messages']:
-                    process_message(message)
-            else:
-                print("No messages. Waiting...")
-            
-        except KeyboardInterrupt:
-            print("\nShutting down gracefully...")
-            break
-        except Exception as e:
-            print(f"Worker error: {e}")
-            time.sleep(10)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while True:
+            try:
+                free_slots = MAX_WORKERS - len(in_flight)
+                if free_slots > 0:
+                    # Never receive more than the pool can start at once, so no
+                    # message waits in the executor while its visibility runs down
+                    response = sqs.receive_message(
+                        QueueUrl=QUEUE_URL,
+                        MaxNumberOfMessages=min(10, free_slots),
+                        WaitTimeSeconds=20, 
+                        VisibilityTimeout=VISIBILITY_TIMEOUT,
+                        AttributeNames=['All'],
+                        MessageAttributeNames=['All']
+                    )
+                    
+                    for message in response.get('Messages', []):
+                        in_flight[executor.submit(process_message, message['Body'])] = message
+                    
+                    if not in_flight:
+                        print("No messages. Waiting...")
+                        continue
+                
+                # Block only while every worker is busy; otherwise reap finished
+                # scans and go back to polling for the free slots
+                done, _ = wait(
+                    in_flight,
+                    timeout=None if len(in_flight) >= MAX_WORKERS else 0,
+                    return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    message = in_flight.pop(future)
+                    if not future.result():
+                        continue
+                    try:
+                        sqs.delete_message(
+                            QueueUrl=QUEUE_URL,
+                            ReceiptHandle=message['ReceiptHandle']
+                        )
+                        print(f"Deleted message from SQS")
+                    except Exception as e:
+                        print(f"Failed to delete message {message['MessageId']}: {e}")
+                
+            except KeyboardInterrupt:
+                print("\nShutting down gracefully...")
+                break
+            except Exception as e:
+                print(f"Worker error: {e}")
+                time.sleep(10)
 
 if __name__ == '__main__':
     main()